@@ -0,0 +1,95 @@
+
+import atexit
+import os
+import threading
+from functools import lru_cache
+from types import SimpleNamespace
+from dotenv import load_dotenv
+
+from azure.identity import ChainedTokenCredential, EnvironmentCredential, ManagedIdentityCredential
+from azure.ai.agents import AgentsClient
+
+# ---------------------------------------------------------------------------
+# Client, credential and agent cache shared by the synchronous agent tools
+# (aggregator, cap_metrics, chart). One of each per Prompt Flow process, so all
+# tools reuse the same AAD token and HTTPS connection pool.
+# ---------------------------------------------------------------------------
+dotenv_path = './config.env'
+
+
+@lru_cache(maxsize=None)
+def config() -> SimpleNamespace:
+    """
+    Parse config.env once per process and snapshot the settings the tools need.
+    The *_AGENT / *_AGENT_ID values name pre-provisioned agents (may be empty).
+    """
+    load_dotenv(dotenv_path=dotenv_path)
+    return SimpleNamespace(
+        project_endpoint=os.environ.get("PROJECT_ENDPOINT"),
+        model_deployment=os.environ.get("MODEL_DEPLOYMENT_NAME"),
+        aggregator_agent_id=os.environ.get("PROCESS_CAPABILITY_AGGREGATOR_AGENT"),
+        cap_metric_agent_id=os.environ.get("CAP_METRIC_AGENT_ID"),
+        chart_agent_id=os.environ.get("CHART_AGENT_ID"),
+    )
+
+
+@lru_cache(maxsize=None)
+def credential() -> ChainedTokenCredential:
+    """
+    Process-wide AAD credential: managed identity when it is available (running
+    in Azure), otherwise the AZURE_* service principal from config.env
+    (EnvironmentCredential). The chain is explicit because DefaultAzureCredential
+    tries EnvironmentCredential first, so with config.env loaded it would always
+    pick the service principal and never reach managed identity. The token is
+    cached and refreshed in memory.
+    """
+    config()  # AZURE_* settings must be in os.environ before the chain is built
+    return ChainedTokenCredential(ManagedIdentityCredential(), EnvironmentCredential())
+
+
+@lru_cache(maxsize=None)
+def agents_client() -> AgentsClient:
+    """Process-wide AgentsClient; intentionally never closed so connections stay warm."""
+    return AgentsClient(
+        endpoint=config().project_endpoint,
+        credential=credential(),
+    )
+
+
+def _delete_agent(agent_id: str) -> None:
+    """atexit hook: delete an agent this process created (best effort at shutdown)."""
+    try:
+        agents_client().delete_agent(agent_id)
+    except Exception as e:
+        print(f"Could not delete agent {agent_id}: {e}")
+
+
+def delete_at_exit(agent_id: str) -> None:
+    """Register an agent created by this process for deletion when the process exits."""
+    atexit.register(_delete_agent, agent_id)
+
+
+_agent_lock = threading.Lock()
+_agent_ids: dict[tuple[str, str], str] = {}
+
+
+def get_agent_id(name: str, instructions: str, configured_id: str | None = None) -> str:
+    """
+    Return configured_id if set (a pre-provisioned agent). Otherwise return the
+    agent for (name, instructions), created on first use, reused for the life of
+    the process and deleted at exit.
+    """
+    if configured_id:
+        return configured_id
+    key = (name, instructions)
+    with _agent_lock:
+        agent_id = _agent_ids.get(key)
+        if agent_id is None:
+            agent_id = agents_client().create_agent(
+                model=config().model_deployment,
+                name=name,
+                instructions=instructions,
+            ).id
+            _agent_ids[key] = agent_id
+            delete_at_exit(agent_id)
+    return agent_id
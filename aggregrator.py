@@ -1,24 +1,23 @@
 
 from promptflow import tool
 
-import os
-import time
-from dotenv import load_dotenv
+from string import Template
+from typing import Iterator, Union
 
-from azure.identity import ClientSecretCredential
 from azure.ai.agents import AgentsClient
 from azure.ai.agents.models import (
+    AgentThreadCreationOptions,
     ListSortOrder,
+    MessageDeltaChunk,
     MessageRole,
     MessageTextContent,
+    ThreadMessageOptions,
+    ThreadRun,
 )
 
-# ---------------------------------------------------------------------------
-# Environment configuration
-# Load secrets and settings from a local config file (do not hardcode in source).
-# ---------------------------------------------------------------------------
-dotenv_path = './config.env'
-load_dotenv(dotenv_path=dotenv_path)
+import agents_common
+from run_polling import SUCCESS_STATUSES, wait_for_run
+
 
 def _strip_not_assessed(text: str) -> str:
     """
@@ -32,34 +31,125 @@ def _strip_not_assessed(text: str) -> str:
     return "" if marker in text else text
 
 
+def _is_http_url(value) -> bool:
+    """
+    Helper: True if value looks like a usable http(s) link (e.g. not an "ERROR: ..."
+    message from the chart tool).
+    """
+    return isinstance(value, str) and value.strip().startswith(("http://", "https://"))
+
+
+# ---------------------------------------------------------------------------
+# Run limits
+# Token ceilings for the aggregator run. The completion cap bounds generation
+# time; a run that hits it ends "incomplete" and the partial summary is returned.
+# ---------------------------------------------------------------------------
+MAX_COMPLETION_TOKENS = 800
+MAX_PROMPT_TOKENS = 16000
+
+
+def _stream_aggregation(agents_client: AgentsClient, agent_id: str, user_message: str) -> Iterator[str]:
+    """
+    Helper: run the aggregator agent over SSE and yield text deltas as they arrive,
+    so the first tokens reach the caller without waiting for the whole run.
+    """
+    thread = agents_client.threads.create(
+        messages=[ThreadMessageOptions(role=MessageRole.USER, content=user_message)],
+    )
+
+    with agents_client.runs.stream(
+        thread_id=thread.id,
+        agent_id=agent_id,
+        max_completion_tokens=MAX_COMPLETION_TOKENS,
+        max_prompt_tokens=MAX_PROMPT_TOKENS,
+    ) as stream:
+        for _event_type, event_data, _ in stream:
+            if isinstance(event_data, MessageDeltaChunk):
+                if event_data.text:
+                    yield event_data.text
+            elif isinstance(event_data, ThreadRun) and event_data.status in ["failed", "cancelled", "expired"]:
+                raise RuntimeError(f"Aggregator run ended with status: {event_data.status}")
+
+
+# ---------------------------------------------------------------------------
+# Aggregator prompt skeleton (parsed once at import; filled in per call)
+# ---------------------------------------------------------------------------
+PB_NOT_PROVIDED = "(No process behavior analysis was provided or it was not assessed in this run.)"
+CAP_NOT_PROVIDED = "(No capability metrics analysis was provided or it was not assessed in this run.)"
+
+# Returned without calling the agent when neither analysis nor the chart is usable
+NOTHING_ASSESSED_SUMMARY = """## Process Capability Summary
+
+- **Process behavior:** not available (not assessed in this run).
+- **Capability metrics:** not available (not assessed in this run).
+- **Control chart:** not available.
+
+No analysis could be aggregated. Re-run the flow once process behavior or
+capability results are available.
+"""
+
+_AGG_PROMPT = Template("""
+You are the Process Capability Aggregator Agent.
+
+You receive:
+${pb_raw}
+${pb_clean}
+
+${cap_raw}
+${cap_clean}
+
+${chart}
+
+Your tasks:
+
+1. First, provide a clear overview of common process capability indices
+   (Cp, Cpk, Pp, Ppk, and any others you consider critical) and when each
+   is most appropriate to use (e.g., short-term vs long-term, centered vs uncentered).
+
+2. Then, synthesize the two analyses into a single, coherent engineering narrative:
+   - Identify whether the process appears stable or unstable.
+   - Interpret capability (is the process capable against the given specs?).
+   - Explain how the behavior/stability and capability results fit together.
+   - Call out any conflicts between the behavior analysis and capability metrics.
+
+3. Finally, provide 3–5 concise recommendations for management, e.g.:
+   - Is the process ready for capability reporting?
+   - Should they focus on reducing special causes first?
+   - Specific next steps (data collection, investigation, or adjustment).
+
+4. Include o_chart_url as an embedded link as part of the output
+
+Constraints:
+- Do NOT fabricate numbers that are not provided in the analyses.
+- If one of the sections above is missing or not assessed, clearly state that it
+  was not available and focus on the information you do have.
+- Use headings and short paragraphs or bullet points to keep this readable
+  for engineers and managers.
+""")
+
+
 # ---------------------------------------------------------------------------
 # Prompt Flow Tool: Aggregates behavior analysis + capability metrics
 # into a single management-ready summary
 # ---------------------------------------------------------------------------
 @tool
-def aggregator(o_processbehavior: str, o_capmetrics: str, o_chart_url) -> str:
+def aggregator(
+    o_processbehavior: str,
+    o_capmetrics: str,
+    o_chart_url,
+    stream: bool = False,
+) -> Union[str, Iterator[str]]:
     # -----------------------------------------------------------------------
     # Load required environment variables (fail fast if critical settings unset)
     # -----------------------------------------------------------------------
-    project_endpoint = os.environ.get("PROJECT_ENDPOINT")
-    model_deployment = os.environ.get("MODEL_DEPLOYMENT_NAME")  # Not used directly; kept for consistency
-    process_capability_aggregator_agent = os.environ.get("PROCESS_CAPABILITY_AGGREGATOR_AGENT")
+    config = agents_common.config()
+    project_endpoint = config.project_endpoint
+    process_capability_aggregator_agent = config.aggregator_agent_id
 
     if not project_endpoint:
         raise RuntimeError("PROJECT_ENDPOINT must be set in config.env or environment.")
     if not process_capability_aggregator_agent:
         raise RuntimeError("PROCESS_CAPABILITY_AGGREGATOR_AGENT must be set.")
-    
-    tenant_id = os.environ.get("AZURE_TENANT_ID")
-    client_id = os.environ.get("AZURE_CLIENT_ID")
-    client_secret = os.environ.get("AZURE_CLIENT_SECRET")
-
-    # Build a client credentials token for Azure AI Agents auth
-    credential = ClientSecretCredential(
-        tenant_id=tenant_id,
-        client_id=client_id,
-        client_secret=client_secret,
-    )
 
     # -----------------------------------------------------------------------
     # (Informational) What we aggregate and the expected output
@@ -71,7 +161,9 @@ def aggregator(o_processbehavior: str, o_capmetrics: str, o_chart_url) -> str:
       - Process behavior analysis text from a process behavior agent
       - Process capability analysis / metrics from a capability agent
 
-    Returns a unified, management-ready summary.
+    Returns a unified, management-ready summary. With stream=True the summary
+    is returned as a generator of text chunks (for streaming flow outputs);
+    the default non-streaming path returns the full string for batch runs.
     """
 
     # -----------------------------------------------------------------------
@@ -84,129 +176,90 @@ def aggregator(o_processbehavior: str, o_capmetrics: str, o_chart_url) -> str:
     pb_clean = _strip_not_assessed(o_processbehavior or "")
     cap_clean = _strip_not_assessed(o_capmetrics or "")
 
+    # Nothing substantive left after cleanup and no usable chart link: the agent
+    # could only report that nothing was assessed, so skip the run entirely
+    if not pb_clean and not cap_clean and not _is_http_url(o_chart_url):
+        return NOTHING_ASSESSED_SUMMARY
+
     # -----------------------------------------------------------------------
     # Construct a structured user message for the aggregator agent
     # - Provide both raw and cleaned versions (with explicit fallbacks)
     # - Include chart URL for embedding/linking in the final output
     # -----------------------------------------------------------------------
-    user_message = f"""
-You are the Process Capability Aggregator Agent.
-
-You receive:
-{o_processbehavior}
-{pb_clean if pb_clean else "(No process behavior analysis was provided or it was not assessed in this run.)"}
-
-{o_capmetrics}
-{cap_clean if cap_clean else "(No capability metrics analysis was provided or it was not assessed in this run.)"}
-
-{o_chart_url}
-
-Your tasks:
-
-1. First, provide a clear overview of common process capability indices
-   (Cp, Cpk, Pp, Ppk, and any others you consider critical) and when each
-   is most appropriate to use (e.g., short-term vs long-term, centered vs uncentered).
+    user_message = _AGG_PROMPT.substitute(
+        pb_raw=o_processbehavior,
+        pb_clean=pb_clean or PB_NOT_PROVIDED,
+        cap_raw=o_capmetrics,
+        cap_clean=cap_clean or CAP_NOT_PROVIDED,
+        chart=o_chart_url,
+    )
 
-2. Then, synthesize the two analyses into a single, coherent engineering narrative:
-   - Identify whether the process appears stable or unstable.
-   - Interpret capability (is the process capable against the given specs?).
-   - Explain how the behavior/stability and capability results fit together.
-   - Call out any conflicts between the behavior analysis and capability metrics.
+    # -----------------------------------------------------------------------
+    # Create the Agents client (project-scoped) and run the aggregation
+    # -----------------------------------------------------------------------
+    agents_client = agents_common.agents_client()
+
+    if stream:
+        return _stream_aggregation(agents_client, process_capability_aggregator_agent, user_message)
+
+    # Create an isolated thread holding the composed user message (plain text)
+    # and kick off the run on the existing aggregator agent (by ID from env),
+    # all in one service call
+    run = agents_client.create_thread_and_run(
+        agent_id=process_capability_aggregator_agent,
+        thread=AgentThreadCreationOptions(
+            messages=[ThreadMessageOptions(role=MessageRole.USER, content=user_message)],
+        ),
+        max_completion_tokens=MAX_COMPLETION_TOKENS,
+        max_prompt_tokens=MAX_PROMPT_TOKENS,
+    )
+    thread_id = run.thread_id
 
-3. Finally, provide 3–5 concise recommendations for management, e.g.:
-   - Is the process ready for capability reporting?
-   - Should they focus on reducing special causes first?
-   - Specific next steps (data collection, investigation, or adjustment).
+    # -----------------------------------------------------------------------
+    # Poll the run until completion or failure (adaptive backoff + timeout)
+    # -----------------------------------------------------------------------
+    # The timeout now spans the whole run (it used to start only after
+    # create_and_process had already blocked until completion).
+    # "incomplete" counts as success: the completion token cap was hit.
+    run = wait_for_run(
+        agents_client,
+        run,
+        label="Aggregator run",
+        success_statuses=SUCCESS_STATUSES + ("incomplete",),
+        max_wait_seconds=120,
+    )
 
-4. Include o_chart_url as an embedded link as part of the output
+    # -----------------------------------------------------------------------
+    # Retrieve the assistant's final text (preferred shortcut)
+    # -----------------------------------------------------------------------
+    last = agents_client.messages.get_last_message_text_by_role(
+        thread_id=thread_id,
+        role=MessageRole.AGENT,
+    )
 
-Constraints:
-- Do NOT fabricate numbers that are not provided in the analyses.
-- If one of the sections above is missing or not assessed, clearly state that it
-  was not available and focus on the information you do have.
-- Use headings and short paragraphs or bullet points to keep this readable
-  for engineers and managers.
-"""
+    if last is not None and last.text is not None:
+        return last.text.value
 
     # -----------------------------------------------------------------------
-    # Create the Agents client (project-scoped) and run the aggregation
+    # Fallback: walk the thread newest -> oldest and stop at the first agent
+    # message that carries text, rather than collecting the whole thread
     # -----------------------------------------------------------------------
-    agents_client = AgentsClient(
-        endpoint=project_endpoint,
-        credential=credential,
+    messages = agents_client.messages.list(
+        thread_id=thread_id,
+        order=ListSortOrder.DESCENDING,  # newest -> oldest
+        limit=1,  # page size; the agent reply is normally the newest message
     )
 
-    with agents_client:
-        # Create an isolated thread for this aggregation request
-        thread = agents_client.threads.create()
-
-        # Send the composed user message (plain text) to the aggregator agent
-        agents_client.messages.create(
-            thread_id=thread.id,
-            role=MessageRole.USER,
-            content=user_message,
-        )
-
-        # Kick off the run on an existing aggregator agent (by ID from env)
-        run = agents_client.runs.create_and_process(
-            thread_id=thread.id,
-            agent_id=process_capability_aggregator_agent,
-        )
-
-        # -------------------------------------------------------------------
-        # Poll the run until completion or failure (simple timeout loop)
-        # -------------------------------------------------------------------
-        max_wait_seconds = 30
-        waited = 0
-        poll_interval = 1
-
-        while True:
-            run = agents_client.runs.get(thread_id=thread.id, run_id=run.id)
-
-            if run.status in ["completed", "succeeded"]:  # success states
-                break
-            if run.status in ["failed", "cancelled"]:     # terminal failure states
-                raise RuntimeError(f"Aggregator run ended with status: {run.status}")
-
-            time.sleep(poll_interval)
-            waited += poll_interval
-            if waited > max_wait_seconds:
-                raise TimeoutError(
-                    f"Aggregator run did not complete within {max_wait_seconds} seconds. "
-                    f"Last status: {run.status}"
-                )
-
-        # -------------------------------------------------------------------
-        # Retrieve the assistant's final text (preferred shortcut)
-        # -------------------------------------------------------------------
-        last = agents_client.messages.get_last_message_text_by_role(
-            thread_id=thread.id,
-            role=MessageRole.AGENT,
-        )
-
-        if last is not None and last.text is not None:
-            return last.text.value
-
-        # -------------------------------------------------------------------
-        # Fallback: scan all thread messages and collect agent text blocks
-        # -------------------------------------------------------------------
-        messages = agents_client.messages.list(
-            thread_id=thread.id,
-            order=ListSortOrder.ASCENDING,  # oldest -> newest
-        )
-
-        collected = []
-        for msg in messages:
-            if msg.role != MessageRole.AGENT:
-                continue
-            if not msg.content:
-                continue
-            for item in msg.content:
-                if isinstance(item, MessageTextContent) and item.text:
-                    collected.append(item.text.value)
-
+    for msg in messages:
+        if msg.role != MessageRole.AGENT or not msg.content:
+            continue
+        collected = [
+            item.text.value
+            for item in msg.content
+            if isinstance(item, MessageTextContent) and item.text
+        ]
         if collected:
             return "\n\n".join(collected)
 
-        # If nothing was returned at all, surface a friendly default
-        return "The aggregator agent did not return any text response."
+    # If nothing was returned at all, surface a friendly default
+    return "The aggregator agent did not return any text response."
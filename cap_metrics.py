@@ -1,13 +1,26 @@
 
 from promptflow.core import tool
 
-import os
-from dotenv import load_dotenv
+import agents_common
+from run_polling import wait_for_run
 
-# Azure identity for AAD auth; AgentsClient for model/agent orchestration
-from azure.identity import ClientSecretCredential
-from azure.ai.agents import AgentsClient
-from azure.ai.agents.models import McpTool, ToolSet, ListSortOrder
+# AgentsClient models for agent orchestration
+from azure.ai.agents.models import (
+    AgentThreadCreationOptions,
+    ListSortOrder,
+    McpTool,
+    MessageInputTextBlock,
+    MessageRole,
+    ThreadMessageOptions,
+    ToolSet,
+)
+
+
+CAP_AGENT_INSTRUCTIONS = (
+    "You have access to an MCP server called `process-capability-mcp` which "
+    "can compute process capability indices. Use the available MCP tools to "
+    "answer questions and perform tasks."
+)
 
 
 @tool
@@ -15,40 +28,11 @@ def capmetrics(I_DataPoints: str) -> str:
     """
     Prompt Flow tool: Generate process capability metrics via an MCP-enabled Azure AI Agent.
     Input:
-      - I_DataPoints: raw datapoints (string) to analyze (e.g., CSV-like text or a prompt describing data).
+      - I_DataPoints: compact JSON datapoints payload from payload_formatter (data, usl, lsl).
     Output:
       - Aggregated agent response as a single string.
     """
 
-    # --- Configuration & Secrets ---
-    # Load environment variables from a local file so we avoid hardcoding secrets
-    dotenv_path = './config.env'
-    load_dotenv(dotenv_path=dotenv_path)
-
-    # Core project settings & model deployment
-    project_endpoint = os.environ.get("PROJECT_ENDPOINT")
-    model_deployment = os.environ.get("MODEL_DEPLOYMENT_NAME")
-    api_key = os.environ.get("API_KEY")  # Present if using key-based auth (not used below)
-
-    # AAD application credentials for Azure identity (client credentials flow)
-    tenant_id = os.environ.get("AZURE_TENANT_ID")
-    client_id = os.environ.get("AZURE_CLIENT_ID")
-    client_secret = os.environ.get("AZURE_CLIENT_SECRET")
-
-    # Build an AAD credential that the AgentsClient will use to authenticate
-    credential = ClientSecretCredential(
-        tenant_id=tenant_id,
-        client_id=client_id,
-        client_secret=client_secret
-    )
-
-    # --- Agents Client ---
-    # Create the Azure AI Agents client bound to your project endpoint
-    agents_client = AgentsClient(
-        endpoint=project_endpoint,
-        credential=credential
-    )
-
     # --- MCP Tool Setup ---
     # Configure the MCP server (Process Capability MCP)
     mcp_cpk_url = "https://cpkmcp05.azurewebsites.net/mcp"
@@ -67,72 +51,57 @@ def capmetrics(I_DataPoints: str) -> str:
     toolset = ToolSet()
     toolset.add(mcp_cpk_tool)
 
-    response = ""
-
-    # --- Agent Lifecycle & Run ---
-    # Use the client as a context manager to ensure proper resource cleanup
-    with agents_client:
-
-        # 1) Create an agent configured to use your deployed model
-        agent = agents_client.create_agent(
-            model=model_deployment,
-            name="cap-metric-agent",
-            instructions=(
-                "You have access to an MCP server called `process-capability-mcp` which "
-                "can compute process capability indices. Use the available MCP tools to "
-                "answer questions and perform tasks."
-            ),
-        )
-
-        # 2) Create a conversation thread the agent will use to exchange messages
-        thread = agents_client.threads.create()
-
-        # 3) Seed the thread with a user message requesting capability computation
-        prompt = "generate process capability for " + I_DataPoints
-        message = agents_client.messages.create(
-            thread_id=thread.id,
-            role="user",
-            content=prompt,
-        )
-
-        # (Optional) Reaffirm approval mode before running, ensuring tool calls auto-execute
-        mcp_cpk_tool.set_approval_mode("never")
-
-        # 4) Start and process the run, providing the toolset (MCP tools) to the agent
-        run = agents_client.runs.create_and_process(
-            thread_id=thread.id,
-            agent_id=agent.id,
-            toolset=toolset
-        )
-
-        response = ""
-
-        # 5) Poll the run status until it completes or fails
-        # NOTE: This code calls time.sleep(1) but does not import time at the top.
-        # Add `import time` to your imports to avoid a NameError.
-        while True:
-            run = agents_client.runs.get(thread_id=thread.id, run_id=run.id)
-            if run.status in ["completed", "succeeded"]:  # success states
-                break
-            elif run.status in ["failed", "cancelled"]:   # terminal error states
-                raise RuntimeError(f"Run ended with status: {run.status}")
-            time.sleep(1)
-
-        # 6) Retrieve all messages on the thread in ascending order (oldest → newest)
-        messages = agents_client.messages.list(
-            thread_id=thread.id,
-            order=ListSortOrder.ASCENDING
-        )
-
-        # 7) Collect textual content from the messages and aggregate into a single response string
-        response = ""
-        for msg in messages:
-            if msg.text_messages:
-                last_text = msg.text_messages[-1]
-                response += last_text.text.value
-
-        # 8) Clean up: delete the agent after the run finishes to free resources
-        agents_client.delete_agent(agent.id)
-
-    # Return the aggregated response from the agent
-    return response
+    # --- Agent & Run ---
+    # The client and agent outlive this call, so there is no create/delete or
+    # client teardown around the run.
+    # CAP_METRIC_AGENT_ID if configured, otherwise an agent created once per process
+    agents_client = agents_common.agents_client()
+    agent_id = agents_common.get_agent_id(
+        "cap-metric-agent", CAP_AGENT_INSTRUCTIONS, agents_common.config().cap_metric_agent_id
+    )
+
+    # (Optional) Reaffirm approval mode before running, ensuring tool calls auto-execute
+    mcp_cpk_tool.set_approval_mode("never")
+
+    # 1) Create the thread, seed it with the capability request and start the run
+    #    (with the MCP toolset) in a single service call. The data payload goes in
+    #    its own content block instead of being concatenated into the prompt.
+    content_blocks = [
+        MessageInputTextBlock(text="generate process capability for the following data:"),
+        MessageInputTextBlock(text=I_DataPoints),
+    ]
+    run = agents_client.create_thread_and_run(
+        agent_id=agent_id,
+        thread=AgentThreadCreationOptions(
+            messages=[ThreadMessageOptions(role=MessageRole.USER, content=content_blocks)],
+        ),
+        tools=toolset.definitions,
+        tool_resources=toolset.resources,
+    )
+    thread_id = run.thread_id
+
+    # 2) Poll the run status until it completes or fails (adaptive backoff).
+    #    MCP calls are auto-approved server-side, so "requires_action" is unexpected.
+    run = wait_for_run(agents_client, run)
+
+    # 3) Retrieve the agent's final reply (newest agent text message only)
+    last = agents_client.messages.get_last_message_text_by_role(
+        thread_id=thread_id,
+        role=MessageRole.AGENT
+    )
+    if last is not None and last.text is not None:
+        return last.text.value
+
+    # 4) Fallback: walk the thread newest → oldest and join the text parts of the
+    #    first agent message found, instead of downloading the whole thread
+    messages = agents_client.messages.list(
+        thread_id=thread_id,
+        order=ListSortOrder.DESCENDING,
+        limit=1  # one message per page: the reply is normally the newest
+    )
+    for msg in messages:
+        if msg.role == MessageRole.AGENT and msg.text_messages:
+            return "".join(part.text.value for part in msg.text_messages)
+
+    # No agent text on the thread
+    return ""
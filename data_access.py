@@ -1,8 +1,130 @@
 
 from promptflow import tool
 from azure.storage.blob import BlobServiceClient
-import pandas as pd
+import orjson
+import csv
 import io
+import re
+from functools import lru_cache
+
+# Number of parallel range GETs used to download a blob
+DOWNLOAD_CONCURRENCY = 8
+
+# Transfer tuning: 4 MiB for the first GET, for each parallel range GET and for
+# each socket read while streaming the response body
+TRANSFER_BLOCK_SIZE = 4 * 1024 * 1024
+
+# Blobs at least this large are parsed with pyarrow (imported on first use);
+# smaller ones, the usual case for a capability study, go through the csv module
+ARROW_MIN_BLOB_SIZE = 1024 * 1024
+
+# Cells typed as integers: optional sign and ASCII digits only (no "1_000"),
+# within int64 so orjson can serialize them
+_INT_RE = re.compile(r'[+-]?[0-9]+')
+_INT64_MIN, _INT64_MAX = -2 ** 63, 2 ** 63 - 1
+
+# Cells read as missing (None), as in pandas' default na_values
+_NA_VALUES = frozenset({
+    "", "#N/A", "#N/A N/A", "#NA", "-1.#IND", "-1.#QNAN", "-NaN", "-nan",
+    "1.#IND", "1.#QNAN", "<NA>", "N/A", "NA", "NULL", "NaN", "None", "n/a",
+    "nan", "null",
+})
+
+
+@lru_cache(maxsize=None)
+def _blob_service_client(account_name: str, account_key: str) -> BlobServiceClient:
+    """
+    One BlobServiceClient per storage account, reused across calls so the HTTPS
+    connection pool (and its TLS sessions) survives between rows.
+    """
+    account_url = f"https://{account_name}.blob.core.windows.net"
+    return BlobServiceClient(
+        account_url=account_url,
+        credential=account_key,
+        max_single_get_size=TRANSFER_BLOCK_SIZE,
+        max_chunk_get_size=TRANSFER_BLOCK_SIZE,
+        connection_data_block_size=TRANSFER_BLOCK_SIZE,
+    )
+
+
+def _coerce_column(values: list) -> list:
+    """
+    Type one CSV column the way a dataframe reader would: all int64 integers ->
+    int, all numeric -> float, otherwise left as text. Empty cells and pandas'
+    NA strings ("NA", "N/A", "null", "NaN", ...) become None.
+    Integer columns with a value outside int64 (long serial or lot IDs) stay text.
+    """
+    present = [v for v in values if v not in _NA_VALUES]
+    if all(_INT_RE.fullmatch(v) for v in present):
+        typed = [int(v) for v in present]
+        if not all(_INT64_MIN <= n <= _INT64_MAX for n in typed):
+            typed = present
+    elif any("_" in v or not v.isascii() for v in present):
+        # float() accepts "1_000.5" and non-ASCII digits; a dataframe reader would not
+        typed = present
+    else:
+        try:
+            typed = [float(v) for v in present]
+        except ValueError:
+            typed = present
+    typed = iter(typed)
+    return [next(typed) if v not in _NA_VALUES else None for v in values]
+
+
+def _dedupe_header(header: list) -> list:
+    """
+    Make repeated column names unique the way pandas does ("x", "x.1", "x.2", ...)
+    so no column is silently dropped when rows become dicts.
+    """
+    taken = set()
+    counts = {}
+    names = []
+    for name in header:
+        candidate = name
+        n = counts.get(name, 0)
+        while candidate in taken:
+            n += 1
+            candidate = f"{name}.{n}"
+        counts[name] = n
+        taken.add(candidate)
+        names.append(candidate)
+    return names
+
+
+def _csv_records(data: bytes) -> list:
+    """
+    Parse a small CSV with the stdlib csv module into a list of record dicts,
+    typing each column with _coerce_column.
+    """
+    reader = csv.reader(io.StringIO(data.decode("utf-8-sig"), newline=""))
+    header = next(reader, None)
+    if not header:
+        return []
+    header = _dedupe_header(header)
+    rows = [row for row in reader if row]
+    columns = [
+        _coerce_column([row[i] if i < len(row) else "" for row in rows])
+        for i in range(len(header))
+    ]
+    return [dict(zip(header, values)) for values in zip(*columns)]
+
+
+def _arrow_records(buffer: io.BytesIO) -> list:
+    """
+    Parse a large CSV with Arrow's native reader, reading the downloaded bytes in
+    place (getbuffer() is a view, not a copy). read_csv infers each column type
+    over the whole input, so a value further down (24.5 in an integer-looking
+    column, text in a column empty so far) widens the type instead of failing.
+    Arrow skips a UTF-8 BOM, matching the utf-8-sig handling of the csv path;
+    repeated header names are made unique as in the csv path.
+    """
+    import pyarrow as pa
+    from pyarrow import csv as pa_csv
+
+    table = pa_csv.read_csv(pa.BufferReader(buffer.getbuffer()))
+    table = table.rename_columns(_dedupe_header(table.column_names))
+    return table.to_pylist()
+
 
 @tool
 def data_access_tool(
@@ -18,17 +140,21 @@ def data_access_tool(
     Output: JSON array of records (string) for downstream processing.
     """
 
-    # Step 1: Build the account URL and create a BlobServiceClient using the account key
-    account_url = f"https://{account_name}.blob.core.windows.net"
-    blob_service_client = BlobServiceClient(account_url=account_url, credential=account_key)
+    # Step 1: Get the (cached) BlobServiceClient for the account, authenticated with the account key
+    blob_service_client = _blob_service_client(account_name, account_key)
 
-    # Step 2: Get a BlobClient for the specified container and blob, then download the blob's content as bytes
+    # Step 2: Get a BlobClient for the specified container and blob, then download the blob
+    # with parallel range GETs into an in-memory buffer
     blob_client = blob_service_client.get_container_client(container_name).get_blob_client(blob_name)
-    data = blob_client.download_blob().readall()
+    downloader = blob_client.download_blob(max_concurrency=DOWNLOAD_CONCURRENCY)
+    buffer = io.BytesIO()
+    downloader.readinto(buffer)
 
-    # Step 3: Load the downloaded bytes into a pandas DataFrame
-    # Using utf-8-sig encoding to handle potential BOM in CSV files
-    df = pd.read_csv(io.BytesIO(data), encoding="utf-8-sig")
+    # Step 3: Parse the CSV: stdlib csv for small blobs, Arrow for large ones
+    if downloader.size < ARROW_MIN_BLOB_SIZE:
+        records = _csv_records(buffer.getvalue())
+    else:
+        records = _arrow_records(buffer)
 
-    # Step 4: Convert the DataFrame to a JSON string in "records" format (list of dictionaries)
-    return df.to_json(orient="records")
+    # Step 4: Convert the records to a JSON string in "records" format (list of dictionaries)
+    return orjson.dumps(records).decode()
@@ -0,0 +1,30 @@
+
+from promptflow import tool
+import orjson
+
+# Markdown code fence the formatter LLM sometimes wraps its JSON in
+_FENCE = "```"
+
+
+@tool
+def payload_formatter(formatted_data: str) -> str:
+    """
+    Normalize the process_data_formatter output into one compact JSON payload.
+    Input: LLM text, expected to be {"data": [...], "usl": ..., "lsl": ...}.
+    Output: the same object re-serialized without whitespace (or the trimmed text
+    if it is not valid JSON), shared verbatim by the cap_metrics and chart_creator nodes.
+    """
+
+    # Step 1: Trim whitespace and strip an optional ```json ... ``` fence
+    text = (formatted_data or "").strip()
+    if text.startswith(_FENCE):
+        text = text[len(_FENCE):]
+        if text.startswith("json"):
+            text = text[len("json"):]
+        text = text.rsplit(_FENCE, 1)[0].strip()
+
+    # Step 2: Re-serialize compactly so both agents receive identical, minimal tokens
+    try:
+        return orjson.dumps(orjson.loads(text)).decode()
+    except orjson.JSONDecodeError:
+        return text
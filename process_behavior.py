@@ -1,11 +1,13 @@
 
 from promptflow import tool
-import os
-import time
-from dotenv import load_dotenv
-
-from azure.identity import ClientSecretCredential
-from azure.ai.agents import AgentsClient
+import asyncio
+import math
+import threading
+from functools import lru_cache
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_exponential
+
+from azure.core.exceptions import AzureError, HttpResponseError, ServiceRequestError
+from azure.ai.agents.aio import AgentsClient
 from azure.ai.agents.models import (
     ListSortOrder,
     MessageTextContent,
@@ -13,12 +15,18 @@ from azure.ai.agents.models import (
     MessageInputImageUrlBlock,
     MessageImageUrlParam,
     MessageRole,
+    ThreadRun,
 )
 
+import agents_common
+
 # ---------------------------------------------------------------------------
-# Load environment variables
-# (Values are loaded inside the tool to keep invocation-local configuration.)
+# Project and model configuration
+# (config.env is parsed once by agents_common and bound to module constants,
+# not re-read per call.)
 # ---------------------------------------------------------------------------
+_PROJECT_ENDPOINT = agents_common.config().project_endpoint
+_MODEL_DEPLOYMENT = agents_common.config().model_deployment
 
 
 # ---------------------------------------------------------------------------
@@ -80,13 +88,248 @@ Constraints:
 
 """
 
+# ---------------------------------------------------------------------------
+# Run streaming: the run is started over SSE and its status events are consumed
+# as the service pushes them, instead of polling runs.get on a timer.
+# ---------------------------------------------------------------------------
+async def _stream_run(agents_client: AgentsClient, thread_id: str, agent_id: str) -> ThreadRun | None:
+    """Start a run on the thread and return its last reported state once the stream ends."""
+    run = None
+    async with await agents_client.runs.stream(thread_id=thread_id, agent_id=agent_id) as stream:
+        async for _event_type, event_data, _ in stream:
+            if isinstance(event_data, ThreadRun):
+                run = event_data
+    return run
+
+
+# Seconds allowed for one run: a high-detail vision analysis with six sections
+# can take well over a minute
+MAX_WAIT_SECONDS = 120
+
+# Statuses after which a run has nothing left to cancel
+_TERMINAL_STATUSES = ("completed", "succeeded", "failed", "cancelled", "expired", "incomplete")
+
+
+async def _cancel_latest_run(agents_client: AgentsClient, thread_id: str) -> None:
+    """
+    Cancel the thread's newest run after a client-side timeout, so it does not
+    keep running (and consuming tokens) on the service. Best effort.
+    """
+    try:
+        async for run in agents_client.runs.list(
+            thread_id=thread_id, limit=1, order=ListSortOrder.DESCENDING
+        ):
+            if run.status not in _TERMINAL_STATUSES:
+                await agents_client.runs.cancel(thread_id=thread_id, run_id=run.id)
+            break
+    except AzureError:
+        pass  # finished or already cancelling in the meantime; the timeout is reported anyway
+
+
+# ---------------------------------------------------------------------------
+# Credential, client and agent
+# aio clients are bound to the event loop that opens them, and Prompt Flow may
+# run each async tool call on a loop of its own, so the AgentsClient is opened
+# and closed per call (async with). Its credential is an async view of the
+# process-wide sync credential from agents_common (managed identity, then the
+# AZURE_* service principal), whose token cache does not depend on any loop,
+# so calls do not each fetch a new AAD token. The agent is cached too: one per
+# (endpoint, model), created on first use, kept for the life of the process and
+# deleted at exit (AGENT_INSTRUCTIONS is a constant, so it does not need to be
+# part of the key).
+# ---------------------------------------------------------------------------
+class _AsyncTokenCredential:
+    """Async get_token over a sync credential, for the aio AgentsClient."""
+
+    def __init__(self, credential):
+        self._credential = credential
+
+    async def get_token(self, *scopes, **kwargs):
+        # Normally served from the credential's in-memory cache; a refresh runs
+        # in a worker thread so the event loop is not blocked
+        return await asyncio.to_thread(self._credential.get_token, *scopes, **kwargs)
+
+    async def close(self) -> None:
+        """The wrapped credential is process-wide, so it is never closed here."""
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.close()
+
+
+@lru_cache(maxsize=None)
+def _credential() -> _AsyncTokenCredential:
+    return _AsyncTokenCredential(agents_common.credential())
+
+
+_cache_lock = threading.Lock()
+_agent_ids: dict[tuple[str, str], str] = {}
+
+
+async def _get_agent_id(agents_client: AgentsClient, project_endpoint: str, model_deployment: str) -> str:
+    """
+    Return the process-behavior agent ID for (endpoint, model), creating the agent
+    on first use (deleted at process exit). The lock is not held across the await;
+    if two calls race, the loser deletes its duplicate agent before returning and
+    both use the winner's.
+    """
+    key = (project_endpoint, model_deployment)
+    with _cache_lock:
+        agent_id = _agent_ids.get(key)
+    if agent_id is not None:
+        return agent_id
+
+    agent = await agents_client.create_agent(
+        model=model_deployment,
+        name="process-behavior-agent",
+        instructions=AGENT_INSTRUCTIONS,
+    )
+    with _cache_lock:
+        agent_id = _agent_ids.setdefault(key, agent.id)
+    if agent_id == agent.id:
+        # Created by this process: delete it with the sync client when the process exits
+        agents_common.delete_at_exit(agent_id)
+    else:
+        # Awaited, not scheduled: the call's event loop and client close when the
+        # tool returns, which would cancel a background delete and leak the agent
+        await agents_client.delete_agent(agent.id)
+    return agent_id
+
+
+# ---------------------------------------------------------------------------
+# Retry on transient service errors
+# A connection failure, throttling (429) or server error (5xx) restarts the
+# analysis on a fresh thread: up to 3 attempts, waiting the service's
+# Retry-After when it sends one, otherwise backing off exponentially.
+# ---------------------------------------------------------------------------
+MAX_ATTEMPTS = 3
+# Ceiling for any wait between attempts, backed off or server-requested
+RETRY_MAX_WAIT_SECONDS = 8
+_backoff = wait_exponential(multiplier=0.5, max=RETRY_MAX_WAIT_SECONDS)
+
+
+def _is_transient(exc: BaseException) -> bool:
+    """True for errors worth retrying: connection failures, 429 and 5xx responses."""
+    if isinstance(exc, ServiceRequestError):
+        return True
+    if isinstance(exc, HttpResponseError):
+        status = exc.status_code or 0
+        return status == 429 or status >= 500
+    return False
+
+
+def _retry_wait(retry_state) -> float:
+    """
+    Seconds before the next attempt: the Retry-After header if present, else
+    exponential backoff; clamped to [0, RETRY_MAX_WAIT_SECONDS].
+    """
+    exc = retry_state.outcome.exception()
+    response = getattr(exc, "response", None)
+    try:
+        wait = float(response.headers["Retry-After"])
+    except (AttributeError, KeyError, TypeError, ValueError):
+        return _backoff(retry_state)
+    if not math.isfinite(wait):
+        return _backoff(retry_state)
+    return min(max(wait, 0.0), RETRY_MAX_WAIT_SECONDS)
+
+
+# Decorator for one whole analysis attempt (shared with the batched tool)
+_retry_transient = retry(
+    retry=retry_if_exception(_is_transient),
+    wait=_retry_wait,
+    stop=stop_after_attempt(MAX_ATTEMPTS),
+    reraise=True,
+)
+
+
+@_retry_transient
+async def _analyze(agents_client: AgentsClient, agent_id: str, prompt_text: str, o_chart_url: str) -> str | None:
+    """Run one analysis of the chart on a new thread and return the agent's reply text, if any."""
+    # 1) Create a conversation thread to hold messages and runs
+    thread = await agents_client.threads.create()
+
+    # -------------------------------
+    # Build multimodal message input
+    # (text + image URL with high detail for vision analysis)
+    # -------------------------------
+    content_blocks = [
+        MessageInputTextBlock(text=prompt_text),
+        MessageInputImageUrlBlock(
+            image_url=MessageImageUrlParam(url=o_chart_url, detail="high")
+        ),
+    ]
+
+    # 2) Send the user message to the thread
+    await agents_client.messages.create(
+        thread_id=thread.id,
+        role=MessageRole.USER,
+        content=content_blocks,
+    )
+
+    # 3) Run the agent, following its progress on the event stream (with timeout)
+    try:
+        run = await asyncio.wait_for(
+            _stream_run(agents_client, thread.id, agent_id), timeout=MAX_WAIT_SECONDS
+        )
+    except asyncio.TimeoutError:
+        await _cancel_latest_run(agents_client, thread.id)
+        raise TimeoutError(f"Run did not complete within {MAX_WAIT_SECONDS} seconds.") from None
+
+    # Success states vary by SDK; include both common success markers
+    status = run.status if run is not None else None
+    if status not in ["completed", "succeeded"]:
+        # Terminal failure states (or a stream that ended without a final status)
+        raise RuntimeError(f"Run ended with status: {status}")
+
+    # -------------------------------------------
+    # Extract assistant text only (preferred path)
+    # get_last_message_text_by_role returns most recent assistant text block, if any.
+    # -------------------------------------------
+    last_assistant_text = await agents_client.messages.get_last_message_text_by_role(
+        thread_id=thread.id, role=MessageRole.AGENT
+    )
+
+    final_response: str | None = None
+    if last_assistant_text is not None and last_assistant_text.text is not None:
+        # MessageTextContent.text is a details object; actual string is `.value`
+        final_response = last_assistant_text.text.value
+
+    # -------------------------------------------
+    # Fallback: fetch one small newest-first page and use the first text block of
+    # the most recent agent message with text content. Useful if the shortcut above returns nothing.
+    # -------------------------------------------
+    if not final_response:
+        messages = agents_client.messages.list(
+            thread_id=thread.id,
+            order=ListSortOrder.DESCENDING,  # newest -> oldest
+            limit=5,  # page size: the reply is among the last few messages
+        )
+        async for msg in messages:
+            if msg.role != MessageRole.AGENT:
+                continue
+            # First text block of the newest agent reply; nothing older is read
+            for item in msg.content:
+                if isinstance(item, MessageTextContent) and item.text:
+                    final_response = item.text.value
+                    break
+            if final_response:
+                break
+
+    return final_response
+
+
 # ---------------------------------------------------------------------------
 # Prompt Flow Tool: Process Behavior Analysis
 # ---------------------------------------------------------------------------
 @tool
-def processbehavior(o_capmetrics: str, o_chart_url: str) -> str:
+async def processbehavior(o_capmetrics: str, o_chart_url: str) -> str:
     """
     Analyzes a process behavior (control) chart using Azure Agents with vision capabilities.
+    Async tool: the worker is released while the run is in flight, so several
+    analyses can be awaited concurrently.
 
     Inputs:
         o_capmetrics : str  -> JSON or text description of capability metrics (Cp, Cpk, Pp, Ppk, etc.)
@@ -96,40 +339,6 @@ def processbehavior(o_capmetrics: str, o_chart_url: str) -> str:
         str -> Detailed SPC analysis including stability, anomalies, capability insights, and recommendations.
     """
 
-    # --- Configuration & Secrets ---
-    # Load environment variables (avoid hardcoding secrets)
-    dotenv_path = './config.env'
-    load_dotenv(dotenv_path=dotenv_path)
-
-    # Project and model configuration
-    project_endpoint = os.environ.get("PROJECT_ENDPOINT")
-    model_deployment = os.environ.get("MODEL_DEPLOYMENT_NAME")
-    api_key = os.environ.get("API_KEY")  # If using key-based auth (not used below)
-
-    # AAD (client credentials) for AgentsClient authentication
-    tenant_id = os.environ.get("AZURE_TENANT_ID")
-    client_id = os.environ.get("AZURE_CLIENT_ID")
-    client_secret = os.environ.get("AZURE_CLIENT_SECRET")
-
-    # NOTE: Do NOT commit hardcoded credentials. Keep secrets in environment only.
-    # tenant_id="..."
-    # client_id="..."
-    # client_secret="..."
-
-    # Build credential used by the AgentsClient
-    credential = ClientSecretCredential(
-        tenant_id=tenant_id,
-        client_id=client_id,
-        client_secret=client_secret
-    )
-
-    # --- Agent Client ---
-    # Create the Azure AI Agents client bound to your project endpoint
-    agents_client = AgentsClient(
-        endpoint=project_endpoint,
-        credential=credential,
-    )
-
     # --- Prompt Construction ---
     # User prompt combines SPC request with capability metrics for context
     prompt_text = (
@@ -138,96 +347,15 @@ def processbehavior(o_capmetrics: str, o_chart_url: str) -> str:
         f"Capability Metrics:\n{o_capmetrics}"
     )
 
-    # Use the client as a context manager for lifecycle management
-    with agents_client:
-        # 1) Create an agent configured to use the deployed model and instructions
-        agent = agents_client.create_agent(
-            model=model_deployment,
-            name="process-behavior-agent",
-            instructions=AGENT_INSTRUCTIONS,
-        )
-
-        # 2) Create a conversation thread to hold messages and runs
-        thread = agents_client.threads.create()
-
-        # -------------------------------
-        # Build multimodal message input
-        # (text + image URL with high detail for vision analysis)
-        # -------------------------------
-        content_blocks = [
-            MessageInputTextBlock(text=prompt_text),
-            MessageInputImageUrlBlock(
-                image_url=MessageImageUrlParam(url=o_chart_url, detail="high")
-            ),
-        ]
-
-        # 3) Send the user message to the thread
-        agents_client.messages.create(
-            thread_id=thread.id,
-            role=MessageRole.USER,
-            content=content_blocks,
-        )
-
-        # 4) Execute the agent run (blocking until initial processing finishes)
-        run = agents_client.runs.create_and_process(
-            thread_id=thread.id,
-            agent_id=agent.id,
-        )
-
-        # --- Poll for completion with timeout ---
-        max_wait_seconds = 60
-        waited = 0
-        poll_interval = 1
-
-        while True:
-            run = agents_client.runs.get(thread_id=thread.id, run_id=run.id)
-            # Success states vary by SDK; include both common success markers
-            if run.status in ["completed", "succeeded"]:
-                break
-            # Terminal failure states
-            if run.status in ["failed", "cancelled"]:
-                raise RuntimeError(f"Run ended with status: {run.status}")
-            # Continue polling until timeout
-            time.sleep(poll_interval)
-            waited += poll_interval
-            if waited > max_wait_seconds:
-                raise TimeoutError(
-                    f"Run did not complete within {max_wait_seconds} seconds. Last status: {run.status}"
-                )
-
-        # -------------------------------------------
-        # Extract assistant text only (preferred path)
-        # get_last_message_text_by_role returns most recent assistant text block, if any.
-        # -------------------------------------------
-        last_assistant_text = agents_client.messages.get_last_message_text_by_role(
-            thread_id=thread.id, role=MessageRole.AGENT
-        )
+    # --- Agent Client & Agent ---
+    # The client is closed when the call ends; the credential (and its token) and
+    # the agent are shared across calls (no per-call create/delete).
+    # NOTE: Do NOT commit hardcoded credentials. Keep secrets in environment only.
+    async with AgentsClient(endpoint=_PROJECT_ENDPOINT, credential=_credential()) as agents_client:
+        agent_id = await _get_agent_id(agents_client, _PROJECT_ENDPOINT, _MODEL_DEPLOYMENT)
 
-        final_response: str | None = None
-        if last_assistant_text is not None and last_assistant_text.text is not None:
-            # MessageTextContent.text is a details object; actual string is `.value`
-            final_response = last_assistant_text.text.value
-
-        # -------------------------------------------
-        # Fallback: scan all messages for text content by the agent
-        # Useful if the shortcut above returns nothing.
-        # -------------------------------------------
-        if not final_response:
-            messages = agents_client.messages.list(
-                thread_id=thread.id,
-                order=ListSortOrder.ASCENDING,  # oldest -> newest
-            )
-            collected = []
-            for msg in messages:
-                if msg.role != MessageRole.AGENT:
-                    continue
-                for item in msg.content:
-                    if isinstance(item, MessageTextContent) and item.text:
-                        collected.append(item.text.value)
-            final_response = "\n\n".join(collected) if collected else ""
-
-        # Optional cleanup: delete the agent to free resources
-        agents_client.delete_agent(agent.id)
+        # Steps 1-3 (thread, message, run) and reply extraction, retried on transient errors
+        final_response = await _analyze(agents_client, agent_id, prompt_text, o_chart_url)
 
     # Return analysis or a friendly default if none was produced
     return final_response or "No analysis was produced by the agent."
@@ -0,0 +1,179 @@
+
+from promptflow import tool
+import asyncio
+import re
+
+from azure.ai.agents.aio import AgentsClient
+from azure.ai.agents.models import (
+    MessageInputTextBlock,
+    MessageInputImageUrlBlock,
+    MessageImageUrlParam,
+    MessageRole,
+    ThreadMessageOptions,
+)
+
+# Shared agent cache, run streaming, timeout/cancel, retry and configuration
+# from the single-chart tool
+from process_behavior import (
+    MAX_WAIT_SECONDS,
+    _MODEL_DEPLOYMENT,
+    _PROJECT_ENDPOINT,
+    _cancel_latest_run,
+    _credential,
+    _get_agent_id,
+    _retry_transient,
+    _stream_run,
+)
+
+# ---------------------------------------------------------------------------
+# Batching limits
+# Charts per agent run; larger batches are split into several runs executed
+# concurrently. Each chart gets a full six-section analysis, so batches stay
+# small enough for one reply to fit the output-token ceiling.
+# ---------------------------------------------------------------------------
+MAX_CHARTS_PER_RUN = 4
+
+# Seconds allowed for one batched run: the single-chart limit plus this much for
+# each further chart in the batch
+WAIT_SECONDS_PER_EXTRA_CHART = 60
+
+NO_ANALYSIS = "No analysis was produced by the agent."
+# Charts left without an analysis when the reply was cut short
+INCOMPLETE_ANALYSIS = "ERROR: The batched run ended incomplete before this chart was analyzed."
+
+# The agent is asked to open each analysis with this marker line, which is how
+# the single reply is split back into one analysis per chart. Markdown the model
+# may wrap around it (### heading, **bold**, > quote) is tolerated.
+_SECTION_RE = re.compile(r'^[ \t#*_>]*=== CHART (\d+) ===[ \t*_]*$', re.MULTILINE | re.IGNORECASE)
+
+
+def _batch_content(items: list) -> list:
+    """
+    Build one multimodal user message for a batch: shared instructions, then for
+    each chart its capability metrics (text) followed by the chart image (URL).
+    """
+    blocks = [
+        MessageInputTextBlock(
+            text=(
+                f"Analyze each of the following {len(items)} process behavior charts "
+                "independently and provide a detailed SPC interpretation of each. "
+                "Use the capability metrics supplied with each chart when forming conclusions.\n\n"
+                "Start the analysis of chart N with a line containing only "
+                "'=== CHART N ===' and do not refer to the other charts."
+            )
+        )
+    ]
+    for number, (capmetrics, chart_url) in enumerate(items, start=1):
+        blocks.append(
+            MessageInputTextBlock(text=f"Chart {number}\nCapability Metrics:\n{capmetrics}")
+        )
+        blocks.append(
+            MessageInputImageUrlBlock(
+                image_url=MessageImageUrlParam(url=chart_url, detail="high")
+            )
+        )
+    return blocks
+
+
+def _split_sections(reply: str, count: int, missing: str = NO_ANALYSIS) -> list:
+    """
+    Split the agent reply on the '=== CHART N ===' markers into `count` analyses;
+    charts without a section get `missing`. A reply without markers is returned
+    whole for a single chart; for several charts it cannot be attributed, so it
+    raises instead of being discarded.
+    """
+    if not reply.strip():
+        return [missing] * count
+    markers = list(_SECTION_RE.finditer(reply))
+    if not markers:
+        if count == 1:
+            return [reply.strip()]
+        raise RuntimeError(
+            f"Batch reply for {count} charts has no '=== CHART N ===' markers: {reply[:300]}"
+        )
+    sections = {}
+    for marker, following in zip(markers, markers[1:] + [None]):
+        end = following.start() if following else len(reply)
+        sections[int(marker.group(1))] = reply[marker.end():end].strip()
+    return [sections.get(number) or missing for number in range(1, count + 1)]
+
+
+@_retry_transient
+async def _analyze_chunk(agents_client, agent_id: str, items: list) -> list:
+    """
+    Run the agent once over up to MAX_CHARTS_PER_RUN charts and return one analysis
+    each. Retried as a whole on transient service errors, like the single-chart tool.
+    """
+    # 1) Create the thread already holding the batched message
+    thread = await agents_client.threads.create(
+        messages=[ThreadMessageOptions(role=MessageRole.USER, content=_batch_content(items))],
+    )
+
+    # 2) Run the agent, following its progress on the event stream (with a
+    #    timeout that grows with the batch; the run is cancelled if it fires)
+    max_wait_seconds = MAX_WAIT_SECONDS + WAIT_SECONDS_PER_EXTRA_CHART * (len(items) - 1)
+    try:
+        run = await asyncio.wait_for(
+            _stream_run(agents_client, thread.id, agent_id), timeout=max_wait_seconds
+        )
+    except asyncio.TimeoutError:
+        await _cancel_latest_run(agents_client, thread.id)
+        raise TimeoutError(f"Batch run did not complete within {max_wait_seconds} seconds.") from None
+
+    # "incomplete" (output-token ceiling) still keeps the charts analyzed so far
+    status = run.status if run is not None else None
+    if status not in ["completed", "succeeded", "incomplete"]:
+        raise RuntimeError(f"Batch run ended with status: {status}")
+
+    # 3) Split the agent's reply back into per-chart analyses
+    last = await agents_client.messages.get_last_message_text_by_role(
+        thread_id=thread.id, role=MessageRole.AGENT
+    )
+    reply = last.text.value if last is not None and last.text is not None else ""
+    missing = INCOMPLETE_ANALYSIS if status == "incomplete" else NO_ANALYSIS
+    return _split_sections(reply, len(items), missing)
+
+
+# ---------------------------------------------------------------------------
+# Prompt Flow Tool: Process Behavior Analysis for many charts
+# ---------------------------------------------------------------------------
+@tool
+async def processbehavior_batch(items: list) -> list:
+    """
+    Batched variant of processbehavior: analyzes several process behavior charts
+    with one agent run per MAX_CHARTS_PER_RUN charts instead of one run per chart.
+
+    Inputs:
+        items : list -> [o_capmetrics, o_chart_url] pairs (capability metrics text, chart image URL)
+
+    Returns:
+        list -> one SPC analysis string per input pair, in input order ("ERROR: ..."
+                for charts whose run failed).
+    """
+    items = [(capmetrics, chart_url) for capmetrics, chart_url in items]
+    if not items:
+        return []
+
+    chunks = [
+        items[start:start + MAX_CHARTS_PER_RUN]
+        for start in range(0, len(items), MAX_CHARTS_PER_RUN)
+    ]
+
+    # One client per call, shared by all chunks and closed on return (the
+    # credential and its token are process-wide)
+    async with AgentsClient(endpoint=_PROJECT_ENDPOINT, credential=_credential()) as agents_client:
+        agent_id = await _get_agent_id(agents_client, _PROJECT_ENDPOINT, _MODEL_DEPLOYMENT)
+        results = await asyncio.gather(
+            *(_analyze_chunk(agents_client, agent_id, chunk) for chunk in chunks),
+            return_exceptions=True,
+        )
+
+    # A failed chunk marks only its own charts as failed
+    analyses = []
+    for chunk, chunk_result in zip(chunks, results):
+        if isinstance(chunk_result, Exception):
+            chunk_result = [f"ERROR: Process behavior analysis failed: {chunk_result}"] * len(chunk)
+        elif isinstance(chunk_result, BaseException):
+            raise chunk_result  # cancellation is not a chunk failure
+        analyses.extend(chunk_result)
+    return analyses
@@ -2,27 +2,86 @@ from promptflow import tool
 
 
 import re
+from functools import lru_cache
+from io import StringIO
+
+# Precompiled patterns (module scope, compiled once at import)
+# preprocess_markdown: line-break insertion before block elements
+_RE_HEADER2 = re.compile(r'\s*(#{2,3})\s+')
+_RE_LIST = re.compile(r'\s+(-\s+\*\*)')
+_RE_NUMBERED_ITEM = re.compile(r'\s+(\d+\.\s+\*\*)')
+_RE_BLOCKQUOTE = re.compile(r'\s+(>)')
+# parse_markdown_to_html: one match per line classifies the block type. Each
+# alternative names the group holding the rest of the line, so m.lastgroup is
+# the block kind and m.group(kind) its text; no match means a paragraph.
+_LINE_RE = re.compile(
+    r'^(?:## (?P<h2>.*)|### (?P<h3>.*)|\d+\.\s+(?P<num>.+)|- (?P<ul>.*)|>(?P<bq>.*))$'
+)
+# format_inline: a single tokenizer for every inline element. Alternatives are
+# tried left to right at each position, so $$...$$ wins over $...$; the named
+# group that matched identifies the token. URLs are matched once and told apart
+# (image or generic) by extension in _url_token. Italic text may contain
+# **bold** spans, so ***text*** and *a **b** c* nest as <em><strong>.
+_INLINE_RE = re.compile(
+    r'(?<!["\'=])(?P<url>https?://[^\s<>"\']+)'
+    r'|\\\((?P<latex_i>.+?)\\\)'
+    r'|\\\[(?P<latex_d>.+?)\\\]'
+    r'|\$\$(?P<dd>.+?)\$\$'
+    r'|(?<!\\)\$(?P<d>[^$]+?)\$(?!\$)'
+    r'|\*\*(?P<b>[^*]+)\*\*'
+    r'|\*(?P<i>(?:[^*]|\*\*[^*]+\*\*)+)\*'
+    r'|`(?P<c>[^`]+)`'
+)
+# HTML emitted for each token kind ({} is the captured text)
+_INLINE_HTML = {
+    'url': '<img src="{}" alt="{}" class="embedded-image">',
+    'latex_i': '<span class="math-inline">\\({}\\)</span>',
+    'latex_d': '<div class="math-display">\\[{}\\]</div>',
+    'dd': '<div class="math-display">\\[{}\\]</div>',
+    'd': '<span class="math-inline">\\({}\\)</span>',
+    'b': '<strong>{}</strong>',
+    'i': '<em>{}</em>',
+    'c': '<code>{}</code>',
+}
+# URL extensions rendered as images (alt "Image"); other URLs are "Embedded content"
+_IMG_EXTS = frozenset({'png', 'jpg', 'jpeg', 'gif', 'bmp', 'webp', 'svg'})
+# Sentence punctuation that may follow an image URL without being part of it
+_URL_TRAILING = '.,;:!?)'
+# Greek letters common in SPC reports, as HTML entities (one str.translate pass)
+_GREEK_TABLE = str.maketrans({
+    'σ': '&sigma;',
+    'Σ': '&Sigma;',
+    'μ': '&mu;',
+})
 
 def preprocess_markdown(content):
     """
     Pre-process raw markdown content that may be on a single line.
-    Adds proper line breaks before markdown elements.
+    Adds proper line breaks before markdown elements. Replacements are callbacks,
+    so the matched text is inserted verbatim (no template expansion).
     """
     # Add newlines before headers (## and ###)
-    content = re.sub(r'\s*(#{2,3})\s+', r'\n\n\1 ', content)
+    content = _RE_HEADER2.sub(lambda m: f'\n\n{m.group(1)} ', content)
     
     # Add newlines before list items (- )
-    content = re.sub(r'\s+(-\s+\*\*)', r'\n\1', content)
+    content = _RE_LIST.sub(lambda m: f'\n{m.group(1)}', content)
     
     # Add newlines before numbered items (1. 2. etc)
-    content = re.sub(r'\s+(\d+\.\s+\*\*)', r'\n\n\1', content)
+    content = _RE_NUMBERED_ITEM.sub(lambda m: f'\n\n{m.group(1)}', content)
     
     # Add newlines before blockquotes (>)
-    content = re.sub(r'\s+(>)', r'\n\n\1', content)
+    content = _RE_BLOCKQUOTE.sub(lambda m: f'\n\n{m.group(1)}', content)
     
     return content.strip()
 
 
+def _close_list(buf, open_tag):
+    """Close the open list (if any) and return the new open_tag (always None)."""
+    if open_tag:
+        buf.write(f'</{open_tag}>\n')
+    return None
+
+
 def parse_markdown_to_html(content):
     """
     Manually parse the markdown content into structured HTML.
@@ -32,171 +91,93 @@ def parse_markdown_to_html(content):
     content = preprocess_markdown(content)
     lines = content.split('\n')
     
-    html_parts = []
-    in_list = False
-    list_depth = 0
-    in_ordered_list = False
+    buf = StringIO()
+    open_tag = None  # 'ul' or 'ol' while a list is open
     
     for line in lines:
         line = line.strip()
         if not line:
-            if in_list:
-                html_parts.append('</ul>')
-                in_list = False
-                list_depth = 0
-            if in_ordered_list:
-                html_parts.append('</ol>')
-                in_ordered_list = False
+            open_tag = _close_list(buf, open_tag)
             continue
         
-        # Handle H2 headers (##)
-        if line.startswith('## '):
-            if in_list:
-                html_parts.append('</ul>')
-                in_list = False
-            if in_ordered_list:
-                html_parts.append('</ol>')
-                in_ordered_list = False
-            header_text = line[3:].strip()
-            header_text = format_inline(header_text)
-            html_parts.append(f'<h2>{header_text}</h2>')
-            continue
+        m = _LINE_RE.match(line)
+        kind = m.lastgroup if m else None
         
-        # Handle H3 headers (###)
-        if line.startswith('### '):
-            if in_list:
-                html_parts.append('</ul>')
-                in_list = False
-            if in_ordered_list:
-                html_parts.append('</ol>')
-                in_ordered_list = False
-            header_text = line[4:].strip()
-            header_text = format_inline(header_text)
-            html_parts.append(f'<h3>{header_text}</h3>')
+        # Handle numbered (ol) and unordered (-, ul) list items
+        if kind == 'num' or kind == 'ul':
+            tag = 'ol' if kind == 'num' else 'ul'
+            if open_tag != tag:
+                _close_list(buf, open_tag)
+                buf.write(f'<{tag}>\n')
+                open_tag = tag
+            item_text = format_inline(m.group(kind))
+            buf.write(f'<li>{item_text}</li>\n')
             continue
         
-        # Handle numbered list items
-        numbered_match = re.match(r'^(\d+)\.\s+(.+)$', line)
-        if numbered_match:
-            if in_list:
-                html_parts.append('</ul>')
-                in_list = False
-            if not in_ordered_list:
-                html_parts.append('<ol>')
-                in_ordered_list = True
-            item_text = format_inline(numbered_match.group(2))
-            html_parts.append(f'<li>{item_text}</li>')
-            continue
+        # Any other block ends the open list
+        open_tag = _close_list(buf, open_tag)
         
-        # Handle unordered list items (-)
-        if line.startswith('- '):
-            if in_ordered_list:
-                html_parts.append('</ol>')
-                in_ordered_list = False
-            if not in_list:
-                html_parts.append('<ul>')
-                in_list = True
-            item_text = format_inline(line[2:])
-            html_parts.append(f'<li>{item_text}</li>')
-            continue
+        # Handle H2 headers (##)
+        if kind == 'h2':
+            header_text = format_inline(m.group('h2').strip())
+            buf.write(f'<h2>{header_text}</h2>\n')
+        
+        # Handle H3 headers (###)
+        elif kind == 'h3':
+            header_text = format_inline(m.group('h3').strip())
+            buf.write(f'<h3>{header_text}</h3>\n')
         
         # Handle blockquotes
-        if line.startswith('>'):
-            if in_list:
-                html_parts.append('</ul>')
-                in_list = False
-            if in_ordered_list:
-                html_parts.append('</ol>')
-                in_ordered_list = False
-            quote_text = format_inline(line[1:].strip())
-            html_parts.append(f'<blockquote>{quote_text}</blockquote>')
-            continue
+        elif kind == 'bq':
+            quote_text = format_inline(m.group('bq').strip())
+            buf.write(f'<blockquote>{quote_text}</blockquote>\n')
         
         # Regular paragraph
-        if in_list:
-            html_parts.append('</ul>')
-            in_list = False
-        if in_ordered_list:
-            html_parts.append('</ol>')
-            in_ordered_list = False
-        html_parts.append(f'<p>{format_inline(line)}</p>')
+        else:
+            buf.write(f'<p>{format_inline(line)}</p>\n')
     
-    # Close any open lists
-    if in_list:
-        html_parts.append('</ul>')
-    if in_ordered_list:
-        html_parts.append('</ol>')
+    # Close any open list
+    _close_list(buf, open_tag)
     
-    return '\n'.join(html_parts)
+    return buf.getvalue()
 
 
-def format_inline(text):
-    """Format inline elements like bold, italic, code, and URLs as images."""
-    # Handle URLs - convert to embedded images
-    # Match URLs starting with http:// or https://
-    text = re.sub(
-        r'(https?://[^\s<>"\']+\.(?:png|jpg|jpeg|gif|bmp|webp|svg))',
-        r'<img src="\1" alt="Image" class="embedded-image">',
-        text,
-        flags=re.IGNORECASE
-    )
-    # Convert any remaining URLs to embedded images (assuming they might be images)
-    text = re.sub(
-        r'(?<!["\'])(?<!=)(https?://[^\s<>"\']+)(?!["\'])',
-        r'<img src="\1" alt="Embedded content" class="embedded-image">',
-        text
-    )
-    # Handle LaTeX inline formulas \( ... \)
-    text = re.sub(
-        r'\\\((.+?)\\\)',
-        r'<span class="math-inline">\\(\1\\)</span>',
-        text
-    )
-    # Handle LaTeX display formulas \[ ... \]
-    text = re.sub(
-        r'\\\[(.+?)\\\]',
-        r'<div class="math-display">\\[\1\\]</div>',
-        text
-    )
-    # Handle LaTeX inline formulas $ ... $ (single dollar)
-    text = re.sub(
-        r'(?<!\\)\$([^$]+?)\$(?!\$)',
-        r'<span class="math-inline">\\(\1\\)</span>',
-        text
-    )
-    # Handle LaTeX display formulas $$ ... $$
-    text = re.sub(
-        r'\$\$(.+?)\$\$',
-        r'<div class="math-display">\\[\1\\]</div>',
-        text
-    )
-    # Handle **bold**
-    text = re.sub(r'\*\*([^*]+)\*\*', r'<strong>\1</strong>', text)
-    # Handle *italic*
-    text = re.sub(r'\*([^*]+)\*', r'<em>\1</em>', text)
-    # Handle `code`
-    text = re.sub(r'`([^`]+)`', r'<code>\1</code>', text)
-    # Handle Greek letters (σ)
-    text = text.replace('σ', '&sigma;')
-    return text
+def _url_token(url):
+    """Render a URL as an embedded image; image extensions get alt "Image"."""
+    head = url.rstrip(_URL_TRAILING)
+    # Judge the extension on the path alone (a SAS token or fragment may follow it)
+    path = head.split('?', 1)[0].split('#', 1)[0]
+    if path.rsplit('.', 1)[-1].lower() in _IMG_EXTS:
+        # Trailing punctuation (e.g. the full stop ending a sentence) stays as text
+        return _INLINE_HTML['url'].format(head, 'Image') + url[len(head):]
+    return _INLINE_HTML['url'].format(url, 'Embedded content')
 
 
+def _inline_token(match):
+    """Render one inline token; bold/italic text is itself formatted (e.g. code inside bold)."""
+    kind = match.lastgroup
+    value = match.group(kind)
+    if kind == 'url':
+        return _url_token(value)
+    if kind in ('b', 'i'):
+        value = _INLINE_RE.sub(_inline_token, value)
+    return _INLINE_HTML[kind].format(value)
 
-def render_markdown_to_html(markdown_content):
-    """
-    Reads a Markdown file, converts it to a beautifully formatted HTML document.
-    
-    Args:
-        input_file (str): Path to the input Markdown file.
-        output_file (str): Path to save the formatted HTML output.
-    """
-    try:
-       
-        # Parse markdown to HTML using custom parser
-        html_body = parse_markdown_to_html(markdown_content)
 
-        # Create a complete HTML document with professional CSS styling
-        html_document = f"""<!DOCTYPE html>
+def format_inline(text):
+    """Format inline elements like bold, italic, code, LaTeX, and URLs as images."""
+    # Handle URLs (as embedded images), LaTeX \( \) \[ \] $ $$, **bold**, *italic*
+    # and `code` in one scan of the text
+    text = _INLINE_RE.sub(_inline_token, text)
+    # Handle Greek letters (σ, μ, ...) in a single pass
+    text = text.translate(_GREEK_TABLE)
+    return text
+
+
+# Complete HTML document with professional CSS styling, split around the report
+# body. Built once at import; render_markdown_to_html only concatenates.
+# Indentation and blank lines are stripped once here to keep uploads small.
+_HTML_PREFIX = re.sub(r'\n\s+', '\n', """<!DOCTYPE html>
         <html lang="en">
         <head>
             <meta charset="UTF-8">
@@ -205,23 +186,23 @@ def render_markdown_to_html(markdown_content):
             <script src="https://polyfill.io/v3/polyfill.min.js?features=es6"></script>
             <script id="MathJax-script" async src="https://cdn.jsdelivr.net/npm/mathjax@3/es5/tex-mml-chtml.js"></script>
             <style>
-                .math-inline {{
+                .math-inline {
                     display: inline;
-                }}
+                }
                 
-                .math-display {{
+                .math-display {
                     display: block;
                     text-align: center;
                     margin: 15px 0;
                     overflow-x: auto;
-                }}
-                * {{
+                }
+                * {
                     margin: 0;
                     padding: 0;
                     box-sizing: border-box;
-                }}
+                }
                 
-                body {{
+                body {
                     font-family: 'Segoe UI', Tahoma, Geneva, Verdana, sans-serif;
                     line-height: 1.8;
                     color: #333;
@@ -229,131 +210,131 @@ def render_markdown_to_html(markdown_content):
                     margin: 0 auto;
                     padding: 40px 20px;
                     background-color: #f5f5f5;
-                }}
+                }
                 
-                .container {{
+                .container {
                     background-color: white;
                     padding: 50px;
                     border-radius: 10px;
                     box-shadow: 0 2px 15px rgba(0,0,0,0.1);
-                }}
+                }
                 
-                h2 {{
+                h2 {
                     color: #2c3e50;
                     font-size: 1.2em;
                     margin-top: 35px;
                     margin-bottom: 20px;
                     padding-bottom: 10px;
                     border-bottom: 3px solid #3498db;
-                }}
+                }
                 
-                h3 {{
+                h3 {
                     color: #34495e;
                     font-size: 1em;
                     margin-top: 25px;
                     margin-bottom: 15px;
-                }}
+                }
                 
-                h2:first-child {{
+                h2:first-child {
                     margin-top: 0;
-                }}
+                }
                 
-                ul {{
+                ul {
                     margin-left: 25px;
                     margin-bottom: 15px;
-                }}
+                }
                 
-                li {{
+                li {
                     margin-bottom: 10px;
                     padding-left: 5px;
-                }}
+                }
                 
-                ul ul {{
+                ul ul {
                     margin-top: 10px;
                     margin-bottom: 10px;
-                }}
+                }
                 
-                strong {{
+                strong {
                     color: #2c3e50;
-                }}
+                }
                 
-                p {{
+                p {
                     margin-bottom: 15px;
                     text-align: justify;
-                }}
+                }
                 
-                blockquote {{
+                blockquote {
                     background-color: #ecf0f1;
                     border-left: 4px solid #3498db;
                     padding: 15px 20px;
                     margin: 20px 0;
                     font-style: italic;
                     color: #555;
-                }}
+                }
                 
-                ol {{
+                ol {
                     margin-left: 25px;
                     margin-bottom: 15px;
-                }}
+                }
                 
-                ol li {{
+                ol li {
                     margin-bottom: 15px;
-                }}
+                }
                 
-                code {{
+                code {
                     background-color: #f8f8f8;
                     padding: 2px 6px;
                     border-radius: 3px;
                     font-family: 'Consolas', monospace;
                     font-size: 0.9em;
-                }}
+                }
                 
-                .embedded-image {{
+                .embedded-image {
                     max-width: 100%;
                     height: auto;
                     display: block;
                     margin: 20px auto;
                     border-radius: 8px;
                     box-shadow: 0 2px 10px rgba(0,0,0,0.15);
-                }}
+                }
                 
-                .header {{
+                .header {
                     text-align: center;
                     margin-bottom: 40px;
                     padding-bottom: 20px;
                     border-bottom: 2px solid #eee;
-                }}
+                }
                 
-                .header h1 {{
+                .header h1 {
                     color: #2c3e50;
                     font-size: 2.2em;
                     margin-bottom: 10px;
-                }}
+                }
                 
-                .header .subtitle {{
+                .header .subtitle {
                     color: #7f8c8d;
                     font-size: 0.6em;
-                }}
+                }
                 
-                .footer {{
+                .footer {
                     margin-top: 40px;
                     padding-top: 20px;
                     border-top: 2px solid #eee;
                     text-align: center;
                     color: #7f8c8d;
                     font-size: 0.9em;
-                }}
+                }
                 
-                @media print {{
-                    body {{
+                @media print {
+                    body {
                         background-color: white;
                         padding: 0;
-                    }}
-                    .container {{
+                    }
+                    .container {
                         box-shadow: none;
                         padding: 20px;
-                    }}
-                }}
+                    }
+                }
             </style>
         </head>
         <body>
@@ -363,7 +344,9 @@ def render_markdown_to_html(markdown_content):
                     <p class="subtitle">Technical Report</p>
                 </div>
                 
-                {html_body}
+                """)
+
+_HTML_SUFFIX = re.sub(r'\n\s+', '\n', """
                 
                 <div class="footer">
                     <p>Generated Report | Confidential</p>
@@ -371,7 +354,27 @@ def render_markdown_to_html(markdown_content):
             </div>
         </body>
         </html>
-        """
+        """)
+
+
+# Pure function of the markdown text: cache recent renders so Prompt Flow
+# re-executions and retries of the same aggregator output are free
+@lru_cache(maxsize=64)
+def render_markdown_to_html(markdown_content):
+    """
+    Reads a Markdown file, converts it to a beautifully formatted HTML document.
+    
+    Args:
+        input_file (str): Path to the input Markdown file.
+        output_file (str): Path to save the formatted HTML output.
+    """
+    try:
+       
+        # Parse markdown to HTML using custom parser
+        html_body = parse_markdown_to_html(markdown_content)
+
+        # Wrap the body in the static document shell (no per-call formatting)
+        html_document = _HTML_PREFIX + html_body + _HTML_SUFFIX
 
         return html_document
 
@@ -1,7 +1,33 @@
 from promptflow import tool
 from azure.storage.blob import BlobServiceClient, ContentSettings
 import os
-import uuid
+import io
+import gzip
+import secrets
+import threading
+import time
+from functools import lru_cache
+
+# Number of parallel block uploads used for large reports
+UPLOAD_CONCURRENCY = 4
+
+# Containers already confirmed to exist, as (account_name, container_name)
+_known_containers: set[tuple[str, str]] = set()
+_known_containers_lock = threading.Lock()
+
+
+@lru_cache(maxsize=None)
+def _blob_service_client(account_name: str, account_key: str) -> BlobServiceClient:
+    """
+    One BlobServiceClient per storage account, reused across calls so uploads
+    share its HTTPS connection pool.
+    """
+    account_url = f"https://{account_name}.blob.core.windows.net"
+    return BlobServiceClient(
+        account_url=account_url,
+        credential=account_key
+    )
+
 
 # The inputs section will change based on the arguments of the tool function, after you save the code
 # Adding type to arguments and return value will help the system show the types properly
@@ -15,24 +41,25 @@ def reportwriter(account_name: str,
 
     container_name = container_name + "-output"
 
-    # Ensure blob name has .html extension and add unique GUID
+    # Ensure blob name has .html extension and add a unique, time-ordered suffix
+    # (nanosecond timestamp + 32 random bits) so reports list in creation order
     base_name = blob_name.replace('.html', '') if blob_name.endswith('.html') else blob_name
-    blob_name = f"{base_name}-{uuid.uuid4()}.html"
-    
-    # Create account URL
-    account_url = f"https://{account_name}.blob.core.windows.net"
+    suffix = f"{time.time_ns():016x}{secrets.token_hex(4)}"
+    blob_name = f"{base_name}-{suffix}.html"
     
-    # Create BlobServiceClient using account key
-    blob_service_client = BlobServiceClient(
-        account_url=account_url,
-        credential=account_key
-    )
+    # Get the (cached) BlobServiceClient for the account, authenticated with the account key
+    blob_service_client = _blob_service_client(account_name, account_key)
     
-    # Get container client and create if it doesn't exist
-    container_client = blob_service_client.get_container_client(container_name)
-    if not container_client.exists():
-        container_client.create_container(public_access="blob")
-        print(f"Created container: {container_name}")
+    # Get container client and create if it doesn't exist (checked once per process)
+    with _known_containers_lock:
+        container_known = (account_name, container_name) in _known_containers
+    if not container_known:
+        container_client = blob_service_client.get_container_client(container_name)
+        if not container_client.exists():
+            container_client.create_container(public_access="blob")
+            print(f"Created container: {container_name}")
+        with _known_containers_lock:
+            _known_containers.add((account_name, container_name))
     
     # Get blob client
     blob_client = blob_service_client.get_blob_client(
@@ -41,14 +68,19 @@ def reportwriter(account_name: str,
     )
     
 
-    # Set content settings for HTML
-    content_settings = ContentSettings(content_type="text/html")
+    # Set content settings for HTML, stored gzip-compressed (browsers decode it
+    # transparently from the Content-Encoding header)
+    content_settings = ContentSettings(content_type="text/html", content_encoding="gzip")
     
-    # Upload the HTML content
+    # Upload the HTML content: encode and compress once, then stream it from an
+    # in-memory buffer with a known length so large reports go up as parallel block uploads
+    data = gzip.compress(html_content.encode('utf-8'), compresslevel=6)
     blob_client.upload_blob(
-        html_content,
+        io.BytesIO(data),
+        length=len(data),
         overwrite=True,
-        content_settings=content_settings
+        content_settings=content_settings,
+        max_concurrency=UPLOAD_CONCURRENCY
     )
     
     return blob_client.url
\ No newline at end of file
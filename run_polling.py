@@ -0,0 +1,75 @@
+
+import math
+import time
+
+from azure.ai.agents import AgentsClient
+from azure.ai.agents.models import ThreadRun
+
+# ---------------------------------------------------------------------------
+# Run polling shared by the synchronous agent tools (aggregator, cap_metrics,
+# chart). Poll quickly at first (most runs finish in a few seconds), then back
+# off 1.5x so long runs do not hammer the control plane. A Retry-After from the
+# service replaces the backoff, but every interval stays within
+# [POLL_INITIAL_SECONDS, POLL_MAX_SECONDS].
+# ---------------------------------------------------------------------------
+POLL_INITIAL_SECONDS = 0.1
+POLL_MAX_SECONDS = 2.0
+
+SUCCESS_STATUSES = ("completed", "succeeded")
+# MCP tool calls are auto-approved, so "requires_action" means the run is stuck.
+# "incomplete" (token limit or content filter) is terminal too; callers that can
+# use a partial reply list it in success_statuses, which is checked first.
+FAILURE_STATUSES = ("failed", "cancelled", "expired", "requires_action", "incomplete")
+
+
+def run_with_headers(pipeline_response, run, _response_headers):
+    """`cls` hook for runs.get: return the run together with the HTTP response headers."""
+    return run, pipeline_response.http_response.headers
+
+
+def next_poll_interval(current: float, headers) -> float:
+    """
+    Next sleep between status polls: Retry-After (seconds) if the service sent a
+    usable one, otherwise 1.5x the current interval; clamped to the poll bounds.
+    """
+    try:
+        interval = float(headers.get("Retry-After"))
+    except (TypeError, ValueError):
+        interval = current * 1.5
+    if not math.isfinite(interval):
+        interval = current * 1.5
+    return min(max(interval, POLL_INITIAL_SECONDS), POLL_MAX_SECONDS)
+
+
+def wait_for_run(
+    agents_client: AgentsClient,
+    run: ThreadRun,
+    label: str = "Run",
+    success_statuses=SUCCESS_STATUSES,
+    max_wait_seconds: float | None = None,
+) -> ThreadRun:
+    """
+    Poll runs.get until the run reaches a success status and return it.
+    Raises RuntimeError on a terminal failure status and, when max_wait_seconds
+    is given, TimeoutError once the next poll would pass the deadline.
+    """
+    deadline = None if max_wait_seconds is None else time.monotonic() + max_wait_seconds
+    poll_interval = POLL_INITIAL_SECONDS
+
+    while True:
+        if run.status in success_statuses:
+            return run
+        if run.status in FAILURE_STATUSES:
+            raise RuntimeError(f"{label} ended with status: {run.status}")
+
+        if deadline is not None and time.monotonic() + poll_interval > deadline:
+            raise TimeoutError(
+                f"{label} did not complete within {max_wait_seconds} seconds. "
+                f"Last status: {run.status}"
+            )
+        time.sleep(poll_interval)
+
+        run, headers = agents_client.runs.get(
+            thread_id=run.thread_id, run_id=run.id, cls=run_with_headers
+        )
+        poll_interval = next_poll_interval(poll_interval, headers)